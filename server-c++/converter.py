@@ -1,27 +1,159 @@
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import numpy as np
+import argparse
 import glob
+import hashlib
 import os
 import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-arquivos_pgm = glob.glob("*.pgm")
+ARQUIVO_CACHE = ".converter_cache.json"
 
-print(f"Encontrados {len(arquivos_pgm)} arquivos PGM para processar.")
 
-for pgm_path in arquivos_pgm:
+def caminhos_saida(pgm_path):
+    json_path = pgm_path[:-len('.pgm')] + '.json'
+    nome_png = pgm_path[:-len('.pgm')] + '_FINAL.png'
+    return json_path, nome_png
+
+
+def ler_pgm(dados):
+    """Decodifica o conteúdo de um PGM P2 (ASCII, gerado pelo servidor C++) ou P5 (binário) direto com NumPy."""
+    tokens = []
+    pos = 0
+    while len(tokens) < 4:
+        while pos < len(dados) and dados[pos:pos + 1].isspace():
+            pos += 1
+        if dados[pos:pos + 1] == b'#':
+            while pos < len(dados) and dados[pos:pos + 1] not in (b'\n', b'\r'):
+                pos += 1
+            continue
+        inicio = pos
+        while pos < len(dados) and not dados[pos:pos + 1].isspace():
+            pos += 1
+        tokens.append(dados[inicio:pos])
+
+    formato = tokens[0]
+    largura, altura, max_val = int(tokens[1]), int(tokens[2]), int(tokens[3])
+
+    if formato == b'P2':
+        pixels = np.array(dados[pos:].split(), dtype=np.float64)
+    elif formato == b'P5':
+        dtype = np.uint8 if max_val < 256 else np.dtype('>u2')
+        pixels = np.frombuffer(dados, dtype=dtype, count=largura * altura, offset=pos + 1).astype(np.float64)
+    else:
+        raise ValueError(f"Formato PGM não suportado: {formato!r}")
+
+    if pixels.size < largura * altura:
+        raise ValueError(f"PGM incompleto: {pixels.size} de {largura * altura} pixels")
+
+    return pixels[:largura * altura].reshape((altura, largura)) / max_val
+
+
+def ler_entrada(pgm_path):
+    """Lê os bytes do PGM e do JSON (None se ausente) de uma vez, para converter e calcular o hash do mesmo conteúdo."""
+    json_path, _ = caminhos_saida(pgm_path)
+    conteudos = []
+    for caminho in (pgm_path, json_path):
+        if os.path.exists(caminho):
+            with open(caminho, 'rb') as f:
+                conteudos.append(f.read())
+        else:
+            conteudos.append(None)
+    return conteudos
+
+
+def hash_conteudo(dados_pgm, dados_json):
+    h = hashlib.sha1()
+    for dados in (dados_pgm, dados_json):
+        if dados is not None:
+            h.update(dados)
+    return h.hexdigest()
+
+
+def hash_entrada(pgm_path):
+    return hash_conteudo(*ler_entrada(pgm_path))
+
+
+def assinatura_entrada(pgm_path):
+    """(mtime, tamanho) do PGM e do JSON; barato de obter e muda sempre que o servidor reescreve o par."""
+    json_path, _ = caminhos_saida(pgm_path)
+    assinatura = []
+    for caminho in (pgm_path, json_path):
+        try:
+            st = os.stat(caminho)
+            assinatura += [st.st_mtime, st.st_size]
+        except OSError:
+            assinatura += [None, None]
+    return assinatura
+
+
+def esta_atualizado(pgm_path, modo, cache):
+    json_path, nome_png = caminhos_saida(pgm_path)
+    if not os.path.exists(nome_png):
+        return False
+
+    if modo == 'hash':
+        entrada = cache.get(pgm_path)
+        if not isinstance(entrada, dict):
+            return False
+        assinatura = assinatura_entrada(pgm_path)
+        if entrada.get('assinatura') == assinatura:
+            return True
+        # Metadados mudaram (ex.: arquivo tocado ou copiado): só aí vale reler e recalcular o hash
+        if entrada.get('hash') == hash_entrada(pgm_path):
+            entrada['assinatura'] = assinatura
+            return True
+        return False
+
+    mtime_entrada = os.path.getmtime(pgm_path)
+    if os.path.exists(json_path):
+        mtime_entrada = max(mtime_entrada, os.path.getmtime(json_path))
+    return os.path.getmtime(nome_png) >= mtime_entrada
+
+
+def carregar_cache(diretorio):
+    caminho = os.path.join(diretorio, ARQUIVO_CACHE)
+    if not os.path.exists(caminho):
+        return {}
+    try:
+        with open(caminho, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def salvar_cache(diretorio, cache):
+    caminho = os.path.join(diretorio, ARQUIVO_CACHE)
+    temporario = caminho + '.tmp'
+    with open(temporario, 'w') as f:
+        json.dump(cache, f)
+    os.replace(temporario, caminho)
+
+
+def converter_arquivo(pgm_path):
+    """Executado nos processos do pool. Retorna (pgm_path, entrada_cache, erro)."""
+    # A assinatura é tirada antes da leitura: se o servidor reescrever o par depois disso, a próxima
+    # varredura vê a assinatura mudar, recalcula o hash e, como ele difere do renderizado, reconverte.
+    assinatura = assinatura_entrada(pgm_path)
     try:
-        json_path = pgm_path.replace('.pgm', '.json')
+        _, nome_png = caminhos_saida(pgm_path)
+        dados_pgm, dados_json = ler_entrada(pgm_path)
         meta = {}
 
-        if os.path.exists(json_path):
-            with open(json_path, 'r') as f:
-                meta = json.load(f)
+        if dados_json is not None:
+            meta = json.loads(dados_json)
         else:
             print(f"Aviso: JSON não encontrado para {pgm_path}. Usando dados genéricos.")
 
-        img = plt.imread(pgm_path)
+        if dados_pgm is None:
+            raise FileNotFoundError(f"Arquivo não encontrado: {pgm_path}")
+        img = ler_pgm(dados_pgm)
 
-        plt.figure(figsize=(6, 7))
-        plt.imshow(img, cmap='gray')
+        fig = plt.figure(figsize=(6, 7))
+        plt.imshow(img, cmap='gray', vmin=0, vmax=1)
 
         # Título
         algo = meta.get('algo', 'CGNR (C++)')
@@ -41,14 +173,122 @@ for pgm_path in arquivos_pgm:
         plt.xticks([])
         plt.yticks([])
 
-        nome_png = pgm_path.replace('.pgm', '_FINAL.png')
         plt.tight_layout()
         plt.savefig(nome_png, dpi=100)
-        plt.close()
+        plt.close(fig)
 
-        print(f"Gerado com sucesso: {nome_png}")
+        return pgm_path, {"hash": hash_conteudo(dados_pgm, dados_json), "assinatura": assinatura}, None
 
     except Exception as e:
-        print(f"Erro ao processar {pgm_path}: {e}")
+        plt.close('all')
+        return pgm_path, None, str(e)
+
+
+def par_pronto(pgm_path):
+    """No modo observação, só converte quando o JSON (escrito após o PGM pelo servidor) já está completo."""
+    json_path, _ = caminhos_saida(pgm_path)
+    if not os.path.exists(json_path):
+        return False
+    try:
+        with open(json_path, 'r') as f:
+            json.load(f)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+class Estatisticas:
+    def __init__(self):
+        self.inicio = time.time()
+        self.convertidos = 0
+        self.pulados = 0
+        # Soma do tempo dos lotes que tinham conversões; exclui as esperas entre varreduras do modo observação
+        self.tempo_ocupado = 0.0
+        # Caminho -> assinatura da entrada que falhou; só é tentado de novo quando o par mudar
+        self.falhas = {}
+
+    def imprimir_resumo(self):
+        duracao = time.time() - self.inicio
+        taxa = self.convertidos / self.tempo_ocupado if self.tempo_ocupado > 0 else 0.0
+        print("\n========== RESUMO DA CONVERSÃO ==========")
+        print(f"Convertidos.............: {self.convertidos}")
+        print(f"Pulados (atualizados)...: {self.pulados}")
+        print(f"Erros (arquivos)........: {len(self.falhas)}")
+        print(f"Tempo total.............: {duracao:.2f} s")
+        print(f"Tempo convertendo.......: {self.tempo_ocupado:.2f} s")
+        print(f"Vazão...................: {taxa:.2f} imagens/s (sobre o tempo convertendo)")
+        print("=========================================")
+
+
+def processar_lote(executor, arquivos_pgm, args, cache, stats, observando=False):
+    inicio_lote = time.time()
+    pendentes = []
+    for pgm_path in arquivos_pgm:
+        if not args.forcar and esta_atualizado(pgm_path, args.modo, cache):
+            if not observando:
+                stats.pulados += 1
+            continue
+        if stats.falhas.get(pgm_path) == assinatura_entrada(pgm_path):
+            continue
+        # par_pronto lê o JSON, então só é chamado para os poucos arquivos realmente pendentes
+        if observando and not par_pronto(pgm_path):
+            continue
+        pendentes.append(pgm_path)
+
+    futures = [executor.submit(converter_arquivo, p) for p in pendentes]
+    for future in as_completed(futures):
+        pgm_path, entrada_cache, erro = future.result()
+        if erro is None:
+            stats.convertidos += 1
+            stats.falhas.pop(pgm_path, None)
+            cache[pgm_path] = entrada_cache
+            _, nome_png = caminhos_saida(pgm_path)
+            print(f"Gerado com sucesso: {nome_png}")
+        else:
+            stats.falhas[pgm_path] = assinatura_entrada(pgm_path)
+            print(f"Erro ao processar {pgm_path}: {erro}")
+
+    if futures and args.modo == 'hash':
+        salvar_cache(args.diretorio, cache)
+    if pendentes:
+        stats.tempo_ocupado += time.time() - inicio_lote
+    return len(pendentes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converte as saídas PGM/JSON do servidor C++ em PNG.")
+    parser.add_argument('diretorio', nargs='?', default='.', help="Diretório com os arquivos cpp_out_*.pgm")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="Número de processos")
+    parser.add_argument('--modo', choices=['mtime', 'hash'], default='mtime',
+                        help="Critério para considerar um PNG atualizado")
+    parser.add_argument('--forcar', action='store_true', help="Reconverte mesmo os arquivos atualizados")
+    parser.add_argument('--observar', action='store_true', help="Continua observando novos pares PGM/JSON")
+    parser.add_argument('--intervalo', type=float, default=1.0, help="Intervalo de varredura no modo observação (s)")
+    args = parser.parse_args()
+
+    cache = carregar_cache(args.diretorio) if args.modo == 'hash' else {}
+    stats = Estatisticas()
+    padrao = os.path.join(args.diretorio, "*.pgm")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        arquivos_pgm = sorted(glob.glob(padrao))
+        print(f"Encontrados {len(arquivos_pgm)} arquivos PGM para processar.")
+        processar_lote(executor, arquivos_pgm, args, cache, stats)
+
+        if args.observar:
+            print(f"Observando {args.diretorio} (Ctrl+C para encerrar)...")
+            args.forcar = False
+            try:
+                while True:
+                    time.sleep(args.intervalo)
+                    if processar_lote(executor, sorted(glob.glob(padrao)), args, cache, stats, observando=True):
+                        print(f"Total até agora: {stats.convertidos} convertidos, {len(stats.falhas)} com erro.")
+            except KeyboardInterrupt:
+                pass
+
+    stats.imprimir_resumo()
+    print("Conversão concluída!")
+
 
-print("Conversão concluída!")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
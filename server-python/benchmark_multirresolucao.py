@@ -0,0 +1,51 @@
+import numpy as np
+import sys
+from servidor_numPy import carregar_ou_criar_npy, cgnr, cgnr_multirresolucao
+from processamento import Buffers, aplicar_ganho
+
+# Uso: python benchmark_multirresolucao.py [caminho_H caminho_G S N largura altura]
+# Sem argumentos usa um problema sintético suave (sensores abaixo da imagem, dois alvos gaussianos).
+
+ALVOS_RESIDUO = [0.05, 0.02, 0.01]
+CONFIGURACOES = [[2], [4], [4, 2]]
+MAX_ITER = 500
+MAX_ITER_GROSSO = 10
+
+def problema_sintetico(largura=40, altura=40, linhas=4000, semente=1):
+    rng = np.random.default_rng(semente)
+    yy, xx = np.mgrid[0:altura, 0:largura]
+    pixels = np.c_[xx.ravel(), yy.ravel()] / largura
+    sensores = rng.random((linhas, 2)) * [1.0, 1.5] - [0.0, 1.6]
+    dist = np.linalg.norm(sensores[:, None, :] - pixels[None], axis=2)
+    H = np.exp(-((dist - dist.mean()) * 8) ** 2) * rng.choice([-1.0, 1.0], size=(linhas, 1))
+    f_real = (np.exp(-((pixels[:, 0] - 0.5) ** 2 + (pixels[:, 1] - 0.4) ** 2) * 40)
+              + 0.5 * np.exp(-((pixels[:, 0] - 0.25) ** 2 + (pixels[:, 1] - 0.7) ** 2) * 80))
+    g = H @ f_real + 1e-3 * rng.standard_normal(linhas)
+    return "sintetico", H, g, largura, altura
+
+def problema_real(caminho_h, caminho_g, S, N, largura, altura):
+    H = carregar_ou_criar_npy(caminho_h)
+    g = aplicar_ganho(carregar_ou_criar_npy(caminho_g), S, N, Buffers()).copy()
+    return caminho_h, H, g, largura, altura
+
+if __name__ == '__main__':
+    if len(sys.argv) == 7:
+        nome, H, g, largura, altura = problema_real(sys.argv[1], sys.argv[2], *[int(x) for x in sys.argv[3:]])
+    else:
+        nome, H, g, largura, altura = problema_sintetico()
+
+    print(f"Problema: {nome} ({H.shape[0]} x {H.shape[1]}, imagem {largura}x{altura})")
+    print("Custo = passes sobre H em resolução total + passes nos níveis grossos convertidos (1/fator² cada)\n")
+    print(f"{'Alvo ||r||/||g||':<18}{'Método':<14}{'Passes H':>10}{'+ grosso':>10}{'Custo':>9}{'Tempo (ms)':>12}")
+    for alvo in ALVOS_RESIDUO:
+        frio = cgnr(H, g, max_iter=MAX_ITER, tol_residuo=alvo)
+        print(f"{alvo:<18}{'frio':<14}{frio['passes_h']:>10}{0.0:>10.1f}{frio['passes_h']:>9.1f}{frio['tempo_s'] * 1000:>12.2f}")
+        for fatores in CONFIGURACOES:
+            # Chave de cache própria do benchmark; os operadores grossos ficam prontos após a 1ª chamada
+            cgnr_multirresolucao(nome, H, g, largura, altura, fatores=fatores, max_iter_grosso=1, max_iter=1)
+            res = cgnr_multirresolucao(nome, H, g, largura, altura, fatores=fatores, max_iter_grosso=MAX_ITER_GROSSO,
+                                       max_iter=MAX_ITER, tol_residuo=alvo)
+            custo = res['passes_h'] + res['passes_h_grosso_equivalentes']
+            rotulo = "multi " + ",".join(str(f) for f in fatores)
+            print(f"{'':<18}{rotulo:<14}{res['passes_h']:>10}{res['passes_h_grosso_equivalentes']:>10.1f}"
+                  f"{custo:>9.1f}{res['tempo_s'] * 1000:>12.2f}")
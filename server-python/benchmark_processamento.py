@@ -0,0 +1,70 @@
+import numpy as np
+import time
+import tracemalloc
+from scipy.ndimage import maximum_filter
+from processamento import Buffers, aplicar_ganho, pos_processar
+
+REPETICOES = 200
+
+CASOS = [
+    {"nome": "M1", "w": 60, "h": 60, "s": 794, "n": 64},
+    {"nome": "M2", "w": 30, "h": 30, "s": 436, "n": 64},
+]
+
+def ganho_antigo(g, S, N):
+    g_work = g.reshape((S, N)) if g.shape[0] == S*N else g.copy()
+    for l in range(S):
+        gamma = np.sqrt(100 + (l**2)/20)
+        g_work[l, :] *= gamma
+    return g_work.flatten()
+
+def pos_processar_antigo(vetor_f, largura, altura):
+    vetor_sanitizado = np.nan_to_num(vetor_f, nan=0.0, posinf=1.0, neginf=0.0)
+    imagem_matrix = vetor_sanitizado.reshape((altura, largura))
+    f_min = imagem_matrix.min()
+    f_max = imagem_matrix.max()
+    imagem_normalizada = np.zeros_like(imagem_matrix)
+    if (f_max - f_min) > 1e-12:
+        imagem_normalizada = (imagem_matrix - f_min) / (f_max - f_min)
+    threshold_val = np.percentile(imagem_normalizada, 98.0)
+    imagem_final = np.where(imagem_normalizada < threshold_val, 0.0, imagem_normalizada)
+    local_max = maximum_filter(imagem_final, size=3)
+    mask = (imagem_final == local_max)
+    return imagem_final * mask
+
+def medir(funcao, preparar=lambda: None):
+    # Entradas de cada repetição são criadas antes de medir, para não contar cópias que o servidor não faz
+    entradas = [preparar() for _ in range(REPETICOES + 1)]
+    funcao(entradas.pop())  # aquecimento (caches e buffers)
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    for entrada in entradas:
+        funcao(entrada)
+    duracao = time.perf_counter() - inicio
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duracao / REPETICOES * 1000, pico / 1024
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(42)
+    buffers = Buffers()
+
+    print(f"{'Caso':<6}{'Etapa':<8}{'Antigo (ms)':>13}{'Novo (ms)':>11}{'Pico antigo (KB)':>18}{'Pico novo (KB)':>16}")
+    for caso in CASOS:
+        S, N, w, h = caso['s'], caso['n'], caso['w'], caso['h']
+        g = rng.standard_normal(S * N)
+        f = rng.standard_normal(w * h)
+
+        g_ref = g.copy()
+        assert np.allclose(ganho_antigo(g.copy(), S, N), aplicar_ganho(g, S, N, buffers))
+        assert np.array_equal(g, g_ref), "aplicar_ganho não pode modificar g"
+        assert np.allclose(pos_processar_antigo(f, w, h), pos_processar(f, w, h, buffers, aplicar_limpeza=True))
+
+        # O código antigo alterava g no lugar; cada repetição recebe uma cópia nova, feita fora da medição
+        t_old, m_old = medir(lambda g_rep: ganho_antigo(g_rep, S, N), preparar=g.copy)
+        t_new, m_new = medir(lambda _: aplicar_ganho(g, S, N, buffers))
+        print(f"{caso['nome']:<6}{'ganho':<8}{t_old:>13.4f}{t_new:>11.4f}{m_old:>18.1f}{m_new:>16.1f}")
+
+        t_old, m_old = medir(lambda _: pos_processar_antigo(f, w, h))
+        t_new, m_new = medir(lambda _: pos_processar(f, w, h, buffers, aplicar_limpeza=True))
+        print(f"{caso['nome']:<6}{'pos':<8}{t_old:>13.4f}{t_new:>11.4f}{m_old:>18.1f}{m_new:>16.1f}")
@@ -0,0 +1,99 @@
+import numpy as np
+import queue
+from functools import lru_cache
+from scipy.ndimage import maximum_filter
+
+PERCENTIL_LIMPEZA = 98.0
+
+@lru_cache(maxsize=16)
+def obter_ganho(S, N):
+    """Vetor de ganho gamma_l = sqrt(100 + l^2/20) já no formato (S, 1) para broadcast sobre os N sensores."""
+    l = np.arange(S, dtype=np.float64)
+    gamma = np.sqrt(100.0 + (l * l) / 20.0).reshape((S, 1))
+    gamma.flags.writeable = False
+    return gamma
+
+class Buffers:
+    """Área de trabalho de um worker: arrays reaproveitados entre requisições enquanto o formato não muda."""
+
+    def __init__(self):
+        self._arrays = {}
+
+    def obter(self, nome, formato, dtype=np.float64):
+        arr = self._arrays.get(nome)
+        if arr is None or arr.shape != formato or arr.dtype != dtype:
+            arr = np.empty(formato, dtype=dtype)
+            self._arrays[nome] = arr
+        return arr
+
+class PoolBuffers:
+    """Um conjunto de Buffers por tarefa simultânea (o servidor Flask cria uma thread nova por requisição)."""
+
+    def __init__(self, tamanho):
+        self._livres = queue.Queue()
+        for _ in range(tamanho):
+            self._livres.put(Buffers())
+
+    def pegar(self):
+        return self._livres.get()
+
+    def devolver(self, buffers):
+        self._livres.put(buffers)
+
+def aplicar_ganho(g, S, N, buffers):
+    """Aplica o ganho em g sem modificá-lo, escrevendo no buffer 'g' do worker. Retorna o vetor achatado."""
+    g_work = buffers.obter('g', (S, N))
+    np.multiply(np.reshape(g, (S, N)), obter_ganho(S, N), out=g_work)
+    return g_work.reshape(-1)
+
+def _percentil_in_place(valores, percentil):
+    """Igual a np.percentile (interpolação linear), mas particionando 'valores' no lugar em vez de copiar."""
+    n = valores.size
+    pos = (percentil / 100.0) * (n - 1)
+    k = int(np.floor(pos))
+    if k + 1 < n:
+        valores.partition([k, k + 1])
+        return valores[k] + (pos - k) * (valores[k + 1] - valores[k])
+    valores.partition(k)
+    return valores[k]
+
+def pos_processar(vetor_f, largura, altura, buffers, aplicar_limpeza=False, threshold='auto'):
+    """Sanitiza, normaliza para [0, 1] e (opcionalmente) limpa a imagem usando apenas os buffers do worker.
+
+    A imagem retornada pertence ao buffer e só é válida até a próxima chamada com os mesmos buffers.
+    `vetor_f` nunca é escrito (é copiado para o buffer 'img'): o servidor guarda o mesmo array como
+    solução anterior para partida quente, então esta garantia deve ser mantida.
+    """
+    formato = (altura, largura)
+    img = buffers.obter('img', formato)
+    np.copyto(img, np.reshape(vetor_f, formato))
+    np.nan_to_num(img, copy=False, nan=0.0, posinf=1.0, neginf=0.0)
+
+    f_min = img.min()
+    f_max = img.max()
+    if (f_max - f_min) > 1e-12:
+        img -= f_min
+        img *= 1.0 / (f_max - f_min)
+    else:
+        img.fill(0.0)
+
+    if not aplicar_limpeza:
+        return img
+
+    if threshold == 'auto':
+        rascunho = buffers.obter('rascunho', (img.size,))
+        np.copyto(rascunho, img.reshape(-1))
+        threshold_val = _percentil_in_place(rascunho, PERCENTIL_LIMPEZA)
+    else:
+        threshold_val = threshold
+
+    mascara = buffers.obter('mascara', formato, dtype=bool)
+    np.less(img, threshold_val, out=mascara)
+    np.putmask(img, mascara, 0.0)
+
+    # Supressão de não-máximos: zera tudo que não é máximo local na vizinhança 3x3
+    local_max = buffers.obter('local_max', formato)
+    maximum_filter(img, size=3, output=local_max)
+    np.less(img, local_max, out=mascara)
+    np.putmask(img, mascara, 0.0)
+    return img
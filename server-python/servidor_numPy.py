@@ -4,19 +4,47 @@ import os
 import psutil
 import matplotlib
 import threading
-from scipy.ndimage import maximum_filter
+from collections import OrderedDict
+from scipy import sparse
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from flask import Flask, request, jsonify
 from datetime import datetime
+from processamento import Buffers, PoolBuffers, aplicar_ganho, pos_processar
 
 app = Flask(__name__)
 
 MAX_SIMULTANEOUS_TASKS = 4
 semaforo_processamento = threading.Semaphore(MAX_SIMULTANEOUS_TASKS)
+pool_buffers = PoolBuffers(MAX_SIMULTANEOUS_TASKS)
 
 MIN_RAM_MB_LIVRE = 500.0
 
+MODOS_RECONSTRUCAO = ('completo', 'sketch', 'multirresolucao')
+MAX_ITER_PADRAO = 10
+MAX_ITER_LIMITE = 500
+
+# O sketch tem entre MULTIPLO_SKETCH_MIN e MULTIPLO_SKETCH_MAX vezes o número de incógnitas (colunas de H),
+# sempre sobredeterminado e nunca mais que metade das linhas de H, senão não há ganho de tempo
+QUALIDADE_SKETCH_PADRAO = 0.2
+MULTIPLO_SKETCH_MIN = 1.5
+MULTIPLO_SKETCH_MAX = 4.0
+SEMENTE_SKETCH = 42
+MAX_SKETCHES_EM_CACHE = 2
+cache_sketch = OrderedDict()
+trava_sketch = threading.Lock()
+
+FATORES_MULTIRRESOLUCAO_PADRAO = [2]
+FATORES_MULTIRRESOLUCAO_PERMITIDOS = (2, 3, 4, 5)
+MAX_ITER_GROSSO = 10
+MAX_OPERADORES_GROSSOS_EM_CACHE = 4
+cache_grosso = OrderedDict()
+trava_grosso = threading.Lock()
+
+MAX_SOLUCOES_POR_MODELO = 8
+solucoes_anteriores = {}
+trava_solucoes = threading.Lock()
+
 def verificar_memoria_disponivel():
     mem = psutil.virtual_memory()
     mem_livre_mb = mem.available / (1024 * 1024)
@@ -25,31 +53,11 @@ def verificar_memoria_disponivel():
         return False
     return True
 
-def salvar_imagem_com_dados(vetor_f, largura, altura, nome_arquivo, info_dict, aplicar_limpeza=False, threshold='auto'):
+def salvar_imagem_com_dados(vetor_f, largura, altura, nome_arquivo, info_dict, aplicar_limpeza=False, threshold='auto', buffers=None):
     try:
-        vetor_sanitizado = np.nan_to_num(vetor_f, nan=0.0, posinf=1.0, neginf=0.0)
-
-        imagem_matrix = vetor_sanitizado.reshape((altura, largura))
-        f_min = imagem_matrix.min()
-        f_max = imagem_matrix.max()
-        imagem_normalizada = np.zeros_like(imagem_matrix)
-        if (f_max - f_min) > 1e-12:
-            imagem_normalizada = (imagem_matrix - f_min) / (f_max - f_min)
-
-        imagem_final = imagem_normalizada
-
-        if aplicar_limpeza:
-            threshold_val = 0.0
-            if threshold == 'auto':
-                threshold_val = np.percentile(imagem_normalizada, 98.0)
-            else:
-                threshold_val = threshold
-
-            imagem_final = np.where(imagem_normalizada < threshold_val, 0.0, imagem_normalizada)
-
-            local_max = maximum_filter(imagem_final, size=3)
-            mask = (imagem_final == local_max)
-            imagem_final = imagem_final * mask
+        if buffers is None:
+            buffers = Buffers()
+        imagem_final = pos_processar(vetor_f, largura, altura, buffers, aplicar_limpeza=aplicar_limpeza, threshold=threshold)
 
         fig = plt.figure(figsize=(6, 7))
         plt.imshow(imagem_final, cmap='gray', vmin=0, vmax=1)
@@ -83,23 +91,43 @@ def carregar_ou_criar_npy(caminho_csv):
     np.save(caminho_npy, dados)
     return dados
 
-def cgnr(H, g, max_iter=10, tol=1e-4):
+def cgnr(H, g, max_iter=10, tol=1e-4, f0=None, r0=None, tol_residuo=None):
+    """CGNR. `r0` (= g - H f0, quando já conhecido) evita um passe sobre H; com `tol_residuo` o critério
+    de parada passa a ser ||r|| <= tol_residuo * ||g|| em vez de |Δ r·r| < tol."""
     start_time = time.time()
     process = psutil.Process(os.getpid())
     mem_before = process.memory_info().rss
 
-    f = np.zeros(H.shape[1])
-    r = g - H @ f
+    norma_g = np.linalg.norm(g)
+    alvo = None if tol_residuo is None else tol_residuo * norma_g
+
+    if f0 is None:
+        f = np.zeros(H.shape[1])
+        r = g.copy()
+        passes_h = 1
+    elif r0 is not None:
+        f = np.array(f0, dtype=float)
+        r = np.array(r0, dtype=float)
+        passes_h = 1
+    else:
+        f = np.array(f0, dtype=float)
+        r = g - H @ f
+        passes_h = 2
     z = H.T @ r
+    # Em partida fria este é exatamente H^T g, reaproveitado pela busca de soluções anteriores
+    HTg = z if f0 is None else None
     p = z.copy()
     r_dot_r_old = np.dot(r, r)
     z_dot_z_old = np.dot(z, z)
     iterations_done = 0
     erro_final = 0.0
+    if alvo is not None and np.sqrt(r_dot_r_old) <= alvo:
+        max_iter = 0  # o chute inicial já atende o alvo
 
     for i in range(max_iter):
         iterations_done = i + 1
         w = H @ p
+        passes_h += 1
         w_dot_w = np.dot(w, w)
         if w_dot_w < 1e-20: break
         alpha = z_dot_z_old / w_dot_w
@@ -108,8 +136,11 @@ def cgnr(H, g, max_iter=10, tol=1e-4):
         r_dot_r_new = np.dot(r, r)
         epsilon = abs(r_dot_r_new - r_dot_r_old)
         erro_final = epsilon
-        if epsilon < tol and i > 0: break
+        if alvo is not None:
+            if np.sqrt(r_dot_r_new) <= alvo: break
+        elif epsilon < tol and i > 0: break
         z = H.T @ r
+        passes_h += 1
         z_dot_z_new = np.dot(z, z)
         beta = z_dot_z_new / z_dot_z_old
         p = z + beta * p
@@ -118,7 +149,190 @@ def cgnr(H, g, max_iter=10, tol=1e-4):
 
     end_time = time.time()
     mem_used_mb = (process.memory_info().rss - mem_before) / (1024 * 1024)
-    return { "imagem_f": f, "iteracoes": iterations_done, "tempo_s": end_time - start_time, "memoria_mb": mem_used_mb, "erro_final": erro_final }
+    residuo_relativo = np.linalg.norm(r) / norma_g if norma_g > 0 else np.linalg.norm(r)
+    return { "imagem_f": f, "iteracoes": iterations_done, "tempo_s": end_time - start_time, "memoria_mb": mem_used_mb, "erro_final": erro_final,
+             "passes_h": passes_h, "residuo_relativo": residuo_relativo, "HTg": HTg, "r": r }
+
+def ler_parametros_solver(config):
+    """max_iter, tol e tol_residuo (alvo relativo ||r||/||g||) opcionais da requisição, validados."""
+    max_iter = int(config.get('max_iter', MAX_ITER_PADRAO))
+    if not (1 <= max_iter <= MAX_ITER_LIMITE):
+        raise ValueError(f"max_iter deve estar entre 1 e {MAX_ITER_LIMITE}")
+    tol = float(config.get('tol', 1e-4))
+    if not (tol > 0):
+        raise ValueError("tol deve ser positivo")
+    tol_residuo = config.get('tol_residuo')
+    if tol_residuo is not None:
+        tol_residuo = float(tol_residuo)
+        if not (0.0 < tol_residuo < 1.0):
+            raise ValueError("tol_residuo deve estar no intervalo (0, 1)")
+    return {"max_iter": max_iter, "tol": tol, "tol_residuo": tol_residuo}
+
+def obter_do_cache_lru(cache, trava, chave, construir, limite):
+    """Busca `chave` em um OrderedDict usado como LRU; constrói fora da trava e descarta os mais antigos acima de `limite`."""
+    with trava:
+        if chave in cache:
+            cache.move_to_end(chave)
+            return cache[chave]
+
+    valor = construir()
+
+    with trava:
+        valor = cache.setdefault(chave, valor)
+        cache.move_to_end(chave)
+        while len(cache) > limite:
+            cache.popitem(last=False)
+        return valor
+
+def escolher_linhas_sketch(M, n, qualidade=QUALIDADE_SKETCH_PADRAO, linhas=None):
+    """Número de linhas do sketch para H (M x n): `linhas` explícito ou interpolado por `qualidade` entre os múltiplos de n."""
+    minimo = int(np.ceil(MULTIPLO_SKETCH_MIN * n))
+    maximo = min(int(MULTIPLO_SKETCH_MAX * n), M // 2)
+    if minimo > maximo:
+        raise ValueError(f"modelo com {M} linhas e {n} incógnitas é pequeno demais para o modo sketch")
+    if linhas is not None:
+        if not (minimo <= linhas <= maximo):
+            raise ValueError(f"linhas_sketch deve estar entre {minimo} e {maximo} para este modelo")
+        return linhas
+    if not (0.0 < qualidade <= 1.0):
+        raise ValueError("qualidade deve estar no intervalo (0, 1]")
+    return min(int(round((MULTIPLO_SKETCH_MIN + qualidade * (MULTIPLO_SKETCH_MAX - MULTIPLO_SKETCH_MIN)) * n)), maximo)
+
+def obter_sketch(caminho_h, H, linhas):
+    """Projeção aleatória esparsa (CountSketch) de H, calculada uma vez por modelo e reaproveitada.
+
+    Cada linha de H é somada, com sinal aleatório, a uma das `linhas` linhas do sistema reduzido.
+    """
+    def construir():
+        M = H.shape[0]
+        rng = np.random.default_rng(SEMENTE_SKETCH)
+        destino = rng.integers(0, linhas, size=M)
+        sinais = rng.choice([-1.0, 1.0], size=M)
+        S = sparse.csr_matrix((sinais, (destino, np.arange(M))), shape=(linhas, M))
+        return S, np.asarray(S @ H)
+
+    return obter_do_cache_lru(cache_sketch, trava_sketch, (caminho_h, linhas), construir, MAX_SKETCHES_EM_CACHE)
+
+def cgnr_sketch(caminho_h, H, g, qualidade=QUALIDADE_SKETCH_PADRAO, linhas=None, max_iter=10, tol=1e-4):
+    """Resolve o sistema reduzido S·H f = S·g e reporta o resíduo contra o H completo."""
+    start_time = time.time()
+    linhas = escolher_linhas_sketch(H.shape[0], H.shape[1], qualidade, linhas)
+
+    S, H_sketch = obter_sketch(caminho_h, H, linhas)
+    res = cgnr(H_sketch, S @ g, max_iter=max_iter, tol=tol)
+
+    norma_g = np.linalg.norm(g)
+    residuo = np.linalg.norm(g - H @ res['imagem_f'])
+    res['tempo_s'] = time.time() - start_time
+    res['linhas_sketch'] = linhas
+    res['residuo_relativo'] = residuo / norma_g if norma_g > 0 else residuo
+    return res
+
+def obter_operador_grosso(caminho_h, H, largura, altura, fator):
+    """Agrega blocos fator x fator de pixels (colunas de H) em um único pixel grosso.
+
+    Retorna P (pixels finos x grossos), o número de pixels por bloco e H_grosso = H @ P, em cache por modelo.
+    """
+    def construir():
+        larg_g = largura // fator
+        alt_g = altura // fator
+        y, x = np.divmod(np.arange(largura * altura), largura)
+        grosso = (y // fator) * larg_g + (x // fator)
+        P = sparse.csr_matrix((np.ones(largura * altura), (np.arange(largura * altura), grosso)),
+                              shape=(largura * altura, larg_g * alt_g))
+        contagem = np.bincount(grosso, minlength=larg_g * alt_g).astype(float)
+        return P, contagem, np.ascontiguousarray((P.T @ H.T).T)
+
+    return obter_do_cache_lru(cache_grosso, trava_grosso, (caminho_h, largura, altura, fator), construir,
+                              MAX_OPERADORES_GROSSOS_EM_CACHE)
+
+def validar_fatores(fatores, largura, altura):
+    if not isinstance(fatores, (list, tuple)):
+        fatores = [fatores]
+    if not fatores:
+        raise ValueError("fatores não pode ser vazio")
+    try:
+        fatores = sorted(set(int(x) for x in fatores), reverse=True)
+    except (TypeError, ValueError):
+        raise ValueError(f"fatores deve ser um inteiro ou uma lista de inteiros, recebido {fatores!r}")
+    for fator in fatores:
+        if fator not in FATORES_MULTIRRESOLUCAO_PERMITIDOS:
+            raise ValueError(f"fator {fator} não permitido; use {FATORES_MULTIRRESOLUCAO_PERMITIDOS}")
+        if largura % fator or altura % fator:
+            raise ValueError(f"fator {fator} não divide a imagem {largura}x{altura}")
+    return fatores
+
+def cgnr_multirresolucao(caminho_h, H, g, largura, altura, fatores=FATORES_MULTIRRESOLUCAO_PADRAO,
+                         max_iter_grosso=MAX_ITER_GROSSO, max_iter=10, tol=1e-4, tol_residuo=None, ao_gerar_previa=None):
+    """Resolve do nível mais grosso ao mais fino, usando cada solução ampliada como chute inicial do próximo.
+
+    Como H_grosso = H @ P, o resíduo do último nível grosso já é g - H f_fino e é repassado ao CGNR fino.
+    """
+    start_time = time.time()
+    f_fino = None
+    r_fino = None
+    iteracoes_grosso = 0
+    # Custo dos níveis grossos em passes equivalentes sobre H (H_grosso tem 1/fator² das colunas)
+    passes_grosso_equivalentes = 0.0
+    erro_grosso = 0.0
+
+    for fator in validar_fatores(fatores, largura, altura):
+        P, contagem, H_grosso = obter_operador_grosso(caminho_h, H, largura, altura, fator)
+        f0 = None if f_fino is None else (P.T @ f_fino) / contagem
+        res_grosso = cgnr(H_grosso, g, max_iter=max_iter_grosso, tol=tol, f0=f0, tol_residuo=tol_residuo)
+        iteracoes_grosso += res_grosso['iteracoes']
+        passes_grosso_equivalentes += res_grosso['passes_h'] / fator ** 2
+        erro_grosso = res_grosso['erro_final']
+        f_fino = P @ res_grosso['imagem_f']
+        r_fino = res_grosso['r']
+
+    if f_fino is not None and ao_gerar_previa is not None:
+        ao_gerar_previa(f_fino, iteracoes_grosso, erro_grosso, time.time() - start_time)
+
+    res = cgnr(H, g, max_iter=max_iter, tol=tol, f0=f_fino, r0=r_fino, tol_residuo=tol_residuo)
+    res['tempo_s'] = time.time() - start_time
+    res['iteracoes_grosso'] = iteracoes_grosso
+    res['passes_h_grosso_equivalentes'] = passes_grosso_equivalentes
+    return res
+
+def guardar_solucao(caminho_h, nome, f, HTg, iteracoes, partida_fria):
+    """Mantém as últimas MAX_SOLUCOES_POR_MODELO soluções de cada modelo (LRU) e as iterações da última partida fria."""
+    with trava_solucoes:
+        modelo = solucoes_anteriores.setdefault(caminho_h, {"solucoes": OrderedDict(), "iteracoes_frio": None})
+        modelo["solucoes"][nome] = {"f": f, "HTg": HTg}
+        modelo["solucoes"].move_to_end(nome)
+        while len(modelo["solucoes"]) > MAX_SOLUCOES_POR_MODELO:
+            modelo["solucoes"].popitem(last=False)
+        if partida_fria:
+            modelo["iteracoes_frio"] = iteracoes
+
+def buscar_solucao_anterior(caminho_h, HTg, nome='auto'):
+    """Retorna (nome, f0, correlacao, iteracoes_frio) da solução pedida, ou da mais correlacionada em H^T g se nome='auto'."""
+    with trava_solucoes:
+        modelo = solucoes_anteriores.get(caminho_h)
+        if not modelo or not modelo["solucoes"]:
+            return None
+        candidatos = modelo["solucoes"].items()
+        if nome != 'auto':
+            if nome not in modelo["solucoes"]:
+                return None
+            candidatos = [(nome, modelo["solucoes"][nome])]
+        candidatos = list(candidatos)
+        iteracoes_frio = modelo["iteracoes_frio"]
+
+    norma = np.linalg.norm(HTg)
+    melhor = None
+    for nome_cand, entrada in candidatos:
+        denom = norma * np.linalg.norm(entrada["HTg"])
+        correlacao = np.dot(HTg, entrada["HTg"]) / denom if denom > 0 else 0.0
+        if melhor is None or correlacao > melhor[2]:
+            melhor = (nome_cand, entrada, correlacao)
+
+    nome_escolhido, entrada, correlacao = melhor
+    # Ajusta a escala da solução anterior à intensidade do sinal atual
+    a = entrada["HTg"]
+    escala = np.dot(HTg, a) / np.dot(a, a) if np.dot(a, a) > 0 else 1.0
+    return nome_escolhido, escala * entrada["f"], float(correlacao), iteracoes_frio
 
 @app.route('/reconstruir', methods=['POST'])
 def api_reconstruir():
@@ -128,6 +342,7 @@ def api_reconstruir():
     verificar_memoria_disponivel()
 
     semaforo_processamento.acquire()
+    buffers = pool_buffers.pegar()
 
     try:
         print(f"   [SRV] Processando tarefa: {request.json.get('nome_arquivo_base')}...")
@@ -135,23 +350,70 @@ def api_reconstruir():
         config = request.json
         ts_inicio = datetime.now().strftime('%d/%m %H:%M:%S')
 
+        modo = config.get('modo', 'completo')
+        if modo not in MODOS_RECONSTRUCAO:
+            raise ValueError(f"modo '{modo}' inválido; use um de {MODOS_RECONSTRUCAO}")
+
         H = carregar_ou_criar_npy(config['caminho_h'])
         g = carregar_ou_criar_npy(config['caminho_g'])
 
         S, N = int(config['s']), int(config['n'])
-        g_work = g.reshape((S, N)) if g.shape[0] == S*N else g.copy()
-
-        for l in range(S):
-            gamma = np.sqrt(100 + (l**2)/20)
-            g_work[l, :] *= gamma
-        g_flat = g_work.flatten()
+        g_flat = aplicar_ganho(g, S, N, buffers)
+        parametros = ler_parametros_solver(config)
+
+        if modo == 'sketch':
+            linhas = int(config['linhas_sketch']) if 'linhas_sketch' in config else None
+            res = cgnr_sketch(config['caminho_h'], H, g_flat,
+                              qualidade=float(config.get('qualidade', QUALIDADE_SKETCH_PADRAO)), linhas=linhas)
+        elif modo == 'multirresolucao':
+            largura, altura = int(config['largura']), int(config['altura'])
+            nome_previa = f"py_out_{config.get('nome_arquivo_base')}_PREVIA.png"
+            previa_salva = False
+
+            def salvar_previa(f_previa, iteracoes_grosso, erro_grosso, tempo_grosso_s):
+                nonlocal previa_salva
+                info_previa = {
+                    "algo": "CGNR Grosso (Python)",
+                    "nome_base": config.get('nome_arquivo_base'),
+                    "iter": iteracoes_grosso,
+                    "tempo_s": tempo_grosso_s,
+                    "inicio": ts_inicio,
+                    "fim": datetime.now().strftime('%d/%m %H:%M:%S'),
+                    "erro": erro_grosso
+                }
+                previa_salva = salvar_imagem_com_dados(f_previa, largura, altura, nome_previa, info_previa, buffers=buffers)
+
+            res = cgnr_multirresolucao(config['caminho_h'], H, g_flat, largura, altura,
+                                       fatores=config.get('fatores', FATORES_MULTIRRESOLUCAO_PADRAO),
+                                       max_iter_grosso=int(config.get('max_iter_grosso', MAX_ITER_GROSSO)),
+                                       ao_gerar_previa=salvar_previa, **parametros)
+        else:
+            partida_quente = config.get('partida_quente')
+            anterior = None
+            res_frio = None
+            if partida_quente:
+                if config.get('comparar_partida_fria'):
+                    # Referência medida: resolve também a partir de zero (custa uma reconstrução a mais)
+                    res_frio = cgnr(H, g_flat, **parametros)
+                    HTg = res_frio['HTg']
+                else:
+                    HTg = H.T @ g_flat
+                anterior = buscar_solucao_anterior(config['caminho_h'], HTg, partida_quente)
+
+            if anterior is None:
+                res = res_frio if res_frio is not None else cgnr(H, g_flat, **parametros)
+                HTg = res['HTg']
+            else:
+                res = cgnr(H, g_flat, f0=anterior[1], **parametros)
 
-        res = cgnr(H, g_flat)
+            guardar_solucao(config['caminho_h'], config.get('nome_arquivo_base'), res['imagem_f'], HTg,
+                            res['iteracoes'], partida_fria=(anterior is None))
 
         ts_fim = datetime.now().strftime('%d/%m %H:%M:%S')
 
         info_img = {
-            "algo": "CGNR (Python)",
+            "algo": {"sketch": "CGNR Sketch (Python)",
+                     "multirresolucao": "CGNR Multirresolução (Python)"}.get(modo, "CGNR (Python)"),
             "nome_base": config.get('nome_arquivo_base'),
             "iter": res['iteracoes'],
             "tempo_s": res['tempo_s'],
@@ -163,21 +425,59 @@ def api_reconstruir():
 
         nome_limpa = f"py_out_{config.get('nome_arquivo_base')}_FINAL.png"
         salvar_imagem_com_dados(res['imagem_f'], int(config['largura']), int(config['altura']),
-                                nome_limpa, info_img, aplicar_limpeza=True)
+                                nome_limpa, info_img, aplicar_limpeza=True, buffers=buffers)
 
-        return jsonify({
+        resposta = {
             "status": "sucesso",
             "imagem_gerada": nome_limpa,
             "tempo_reconstrucao_s": res['tempo_s'],
             "iteracoes": res['iteracoes'],
-            "memoria_mb": res['memoria_mb']
-        })
+            "memoria_mb": res['memoria_mb'],
+            "modo": modo,
+            "residuo_relativo": float(res['residuo_relativo'])
+        }
+        if modo != 'sketch':
+            # Passes completos sobre H (H·v ou H^T·v) gastos na resolução em resolução total
+            resposta["passes_h"] = res['passes_h']
+
+        if modo == 'sketch':
+            resposta["linhas_sketch"] = res['linhas_sketch']
+        elif modo == 'multirresolucao':
+            resposta["iteracoes_grosso"] = res['iteracoes_grosso']
+            resposta["passes_h_grosso_equivalentes"] = res['passes_h_grosso_equivalentes']
+            resposta["imagem_previa"] = nome_previa if previa_salva else None
+        elif partida_quente:
+            resposta["partida_quente_de"] = None
+            if anterior is None:
+                if partida_quente == 'auto':
+                    motivo = "nenhuma solução guardada para este modelo"
+                else:
+                    motivo = (f"solução '{partida_quente}' não está entre as últimas "
+                              f"{MAX_SOLUCOES_POR_MODELO} guardadas para este modelo")
+                resposta["mensagem_partida_quente"] = f"{motivo}; reconstrução feita a partir de zero"
+            else:
+                nome_anterior, _, correlacao, iteracoes_frio = anterior
+                resposta["partida_quente_de"] = nome_anterior
+                resposta["correlacao"] = correlacao
+                if res_frio is not None:
+                    resposta["iteracoes_partida_fria"] = res_frio['iteracoes']
+                    resposta["iteracoes_economizadas"] = res_frio['iteracoes'] - res['iteracoes']
+                elif iteracoes_frio is not None:
+                    # Estimativa: compara com a última partida fria de outra aquisição do mesmo modelo
+                    resposta["iteracoes_economizadas_estimadas"] = iteracoes_frio - res['iteracoes']
+
+        return jsonify(resposta)
+
+    except ValueError as e:
+        print(f"Erro: {e}")
+        return jsonify({"status": "erro", "mensagem": str(e)}), 400
 
     except Exception as e:
         print(f"Erro: {e}")
         return jsonify({"status": "erro", "mensagem": str(e)}), 500
 
     finally:
+        pool_buffers.devolver(buffers)
         semaforo_processamento.release()
 
 if __name__ == '__main__':